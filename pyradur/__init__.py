@@ -21,6 +21,7 @@
 # SOFTWARE.
 
 from .client import Client
+import functools
 import logging
 import os
 import weakref
@@ -28,32 +29,36 @@ import weakref
 logger = logging.getLogger('pyradur')
 
 class Dict(object):
-    _shared_clients = []
+    _shared_clients = {}
 
     @classmethod
-    def _cleanup_client(cls, ref):
-        cls._shared_clients.remove(ref)
+    def _cleanup_client(cls, shared_key, ref):
+        if cls._shared_clients.get(shared_key) is ref:
+            del cls._shared_clients[shared_key]
 
-    def __init__(self, sock_path, var, *, use_cache=True, share_connection=True):
+    def __init__(self, sock_path, var, *, use_cache=True, share_connection=True,
+            write_coalesce=False):
         if share_connection:
-            for client_ref in self._shared_clients:
-                client = client_ref()
-                try:
-                    if client is not None and os.path.samefile(sock_path, client.sock_path):
-                        logger.debug('Sharing existing client %s', id(client))
-                        break
-                except FileNotFoundError:
-                    pass
+            # Clients that coalesce writes can't be shared with ones that
+            # don't, since the other would not see its writes promptly
+            shared_key = (os.path.realpath(sock_path), write_coalesce)
+            client_ref = self._shared_clients.get(shared_key)
+            client = client_ref() if client_ref is not None else None
+
+            if client is not None:
+                logger.debug('Sharing existing client %s', id(client))
             else:
-                client = Client(sock_path, use_cache)
-                self._shared_clients.append(weakref.ref(client, self._cleanup_client))
+                client = Client(sock_path, use_cache, write_coalesce, initial_vars=[var])
+                self._shared_clients[shared_key] = weakref.ref(client, functools.partial(self._cleanup_client, shared_key))
                 logger.debug('New shared client %s', id(client))
         else:
-            client = Client(sock_path, use_cache)
+            client = Client(sock_path, use_cache, write_coalesce, initial_vars=[var])
             logger.debug('New non-shared client %s', id(client))
 
         self.client = client
         self.var = var
+        # A new client validates the variable when connecting, so this only
+        # sends a request for a shared client that hasn't seen it yet
         self.client.validate_var(var)
 
     def close(self):
@@ -86,6 +91,11 @@ class Dict(object):
     def set(self, key, value):
         return self.client.set(self.var, key, value)
 
+    def bulk_set(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        self.client.bulk_set(self.var, items)
+
     def setdefault(self, key, default=None):
         return self.client.setdefault(self.var, key, default)
 
@@ -22,6 +22,7 @@
 
 from .ipc import IPC, STATUS_OK, STATUS_NO_VAR, STATUS_NO_KEY
 from .shm import SHMSlot, SLOT_UNUSED, SLOT_OK, SLOT_OUT_OF_DATE
+import itertools
 import logging
 import mmap
 import os
@@ -30,22 +31,36 @@ import tempfile
 
 logger = logging.getLogger('pyradur.client')
 
+# Number of coalesced writes to buffer before they are sent to the server
+MAX_WRITE_BUFFER = 1024
+
+# Maximum number of released cache entries kept for reuse
+MAX_CACHE_FREELIST = 256
+
+_UNUSED_BYTE = bytes([SLOT_UNUSED])
+
 class Client(IPC):
     class Cache(SHMSlot):
         def __init__(self, slot, value, shm):
             super().__init__(slot, shm, logger=logger)
             self.value = value
 
-    def __init__(self, sock_path, use_cache=True):
+    def __init__(self, sock_path, use_cache=True, write_coalesce=False, initial_vars=()):
         super().__init__(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), logger=logger)
         self.sock_path = sock_path
         self.sock.connect(self.sock_path)
         self.use_cache = use_cache
-        self.seq = 0
+        self._next_seq = itertools.count(1).__next__
         self.known_vars = set()
+        # Responses that arrived while waiting for a different one
+        self.responses = {}
+        self.write_coalesce = write_coalesce
+        self.write_buffer = {}
+        pending = []
 
         if self.use_cache:
             self.cache = {}
+            self.cache_freelist = []
 
             self.shm_fd, shm_path = tempfile.mkstemp()
             os.unlink(shm_path)
@@ -54,75 +69,140 @@ class Client(IPC):
 
             self.shm = mmap.mmap(self.shm_fd, 0)
 
+            # Tracks which slots this client has handed out, so that finding
+            # a free slot doesn't require scanning the shared memory
+            self.free_bitmap = bytearray(self.shm.size())
+            # Lowest slot which might be free
+            self.next_free = 0
+
             self.logger.debug('Initial shm size is %d', mmap.PAGESIZE)
 
-            self._send_shm_message()
+            # Must wait for response to ensure server sees the map
+            pending.append(self._send_shm_message())
+
+        initial_vars = [v for v in initial_vars if v not in self.known_vars]
+        if initial_vars:
+            pending.append(self._send_validate_vars(initial_vars))
+
+        # All setup requests are sent together. Responses arrive in order
+        for seq in pending:
+            self._wait_for_response(seq)
+
+        self.known_vars.update(initial_vars)
 
     def _do_close(self):
-        if self.use_cache:
-            self.shm.close()
-            os.close(self.shm_fd)
+        try:
+            if self.write_buffer:
+                self._queue_writes()
+                self.flush()
+        finally:
+            # The server may already be gone, but everything must still be
+            # cleaned up
+            if self.use_cache:
+                self.shm.close()
+                os.close(self.shm_fd)
+
+            super()._do_close()
+
+    def _send_validate_vars(self, variables):
+        seq = self._next_seq()
+        self.send_message({
+            'validate-vars': {
+                'seq': seq,
+                'vars': variables,
+                }
+            }, batch=True)
+        return seq
+
+    def validate_vars(self, variables):
+        variables = [v for v in variables if v not in self.known_vars]
+        if not variables:
+            return
 
-        super()._do_close()
+        self._wait_for_response(self._send_validate_vars(variables))
+
+        self.known_vars.update(variables)
 
     def validate_var(self, var):
-        if var in self.known_vars:
-            return
+        self.validate_vars([var])
 
+    def _send_shm_message(self):
+        seq = self._next_seq()
         self.send_message({
-            'validate-var': {
-                'seq': self._next_seq(),
-                'var': var,
+            'shm': {
+                'seq': seq,
+                'size': self.shm.size()
                 }
-            })
+            }, [self.shm_fd], batch=True)
+        return seq
 
-        self._wait_for_response()
+    def _grow_shm(self):
+        new_size = max(self.shm.size() * 2, mmap.PAGESIZE * 16)
+
+        try:
+            self.shm.resize(new_size)
+        except (OSError, SystemError):
+            # Not all platforms can resize a mapping in place
+            os.ftruncate(self.shm_fd, new_size)
+            self.shm.close()
+            self.shm = mmap.mmap(self.shm_fd, 0)
+            for c in self.cache.values():
+                c.shm = self.shm
 
-        self.known_vars.add(var)
+        self.free_bitmap.extend(bytes(self.shm.size() - len(self.free_bitmap)))
 
-    def _send_shm_message(self):
+        # The server doesn't keep the fd around, so it has to be sent again
+        # to let the server map the new size. It is handled before any
+        # message that uses the new slots, so there is no need to wait for a
+        # response here
         self.send_message({
             'shm': {
-                'seq': self._next_seq(),
                 'size': self.shm.size()
                 }
-            }, [self.shm_fd])
+            }, [self.shm_fd], batch=True)
 
-        # Must wait for response to ensure server sees the new map
-        self._wait_for_response()
+        self.logger.debug('shm size is now %d', self.shm.size())
 
-    def _grow_shm(self):
-        self.shm.resize(self.shm.size() + mmap.PAGESIZE)
-        self._send_shm_message()
+    def _find_free_slot(self):
+        slot = self.free_bitmap.find(_UNUSED_BYTE, self.next_free)
+        self.next_free = slot if slot != -1 else len(self.free_bitmap)
 
-    def _next_seq(self):
-        self.seq += 1
-        return self.seq
+        while slot != -1:
+            # A slot released by this client can only be reused once the
+            # server has marked it as unused
+            if self.shm[slot] == SLOT_UNUSED:
+                return slot
+            slot = self.free_bitmap.find(_UNUSED_BYTE, slot + 1)
 
-    def _get_free_slot(self):
-        s = chr(SLOT_UNUSED).encode('utf-8')
+        return -1
 
-        self.shm.seek(0, os.SEEK_SET)
-        slot = self.shm.find(s)
+    def _get_free_slot(self):
+        slot = self._find_free_slot()
 
         if slot == -1:
             self._grow_shm()
 
-            self.shm.seek(0, os.SEEK_SET)
-            slot = self.shm.find(s)
+            slot = self._find_free_slot()
 
             if slot == -1:
                 raise Exception("Cannot find free slot after resizing?")
 
+        self.free_bitmap[slot] = 1
+        if slot == self.next_free:
+            self.next_free = slot + 1
         return slot
 
-    def _wait_for_response(self):
+    def _wait_for_response(self, seq):
         def handle_response(m, fds):
             nonlocal response
-            if m['seq'] == self.seq:
+            if m['seq'] == seq:
                 response = m
+            else:
+                self.responses[m['seq']] = m
 
-        response = None
+        response = self.responses.pop(seq, None)
+
+        self.flush()
 
         while response is None:
             self.process_receive({
@@ -147,16 +227,35 @@ class Client(IPC):
 
         slot = self._get_free_slot()
 
-        logger.debug("Adding %s at slot %d", k, slot)
-        c = self.Cache(slot, None, self.shm)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Adding %s at slot %d", k, slot)
+        if self.cache_freelist:
+            c = self.cache_freelist.pop()
+            c.slot = slot
+            c.shm = self.shm
+        else:
+            c = self.Cache(slot, None, self.shm)
         self.cache[k] = c
 
         return c
 
+    def _release_cache(self, c):
+        self.free_bitmap[c.slot] = 0
+        self.next_free = min(self.next_free, c.slot)
+
+        if len(self.cache_freelist) < MAX_CACHE_FREELIST:
+            c.value = None
+            self.cache_freelist.append(c)
+
     def invalidate(self, var, key):
         if self.use_cache:
             k = (var, key)
             if k in self.cache:
+                # Any buffered write references the slot, so it must reach
+                # the server before the slot is released
+                if k in self.write_buffer:
+                    self.flush_writes()
+
                 self.send_message({
                     'release': {
                         'seq': self._next_seq(),
@@ -168,16 +267,19 @@ class Client(IPC):
                 # The server is responsible for marking the state back to unused
                 # once it is sure all other clients are done with it. The client
                 # can't change the state otherwise it might get overwritten.
-                del self.cache[k]
+                self._release_cache(self.cache.pop(k))
 
     def invalidate_all(self):
         if self.use_cache:
+            self._queue_writes()
             self.send_message({
                 'release-all': {
                     'seq': self._next_seq()
                     }
                 })
 
+            for c in self.cache.values():
+                self._release_cache(c)
             self.cache = {}
 
     def is_cached(self, var, key):
@@ -187,38 +289,67 @@ class Client(IPC):
         return (var, key) in self.cache
 
     def get(self, var, key):
+        k = (var, key)
+        if k in self.write_buffer:
+            value = self.write_buffer[k][0]
+            if value is None:
+                raise KeyError(key)
+            return value
+
         if self.use_cache:
             cache = self._get_cache(var, key)
 
             if cache.status != SLOT_OK:
+                seq = self._next_seq()
                 self.send_message({
                     'get': {
-                        'seq': self._next_seq(),
+                        'seq': seq,
                         'var': var,
                         'key': key,
                         'slot': cache.slot
                         }
                     })
 
-                cache.value = self._wait_for_response()['value']
+                cache.value = self._wait_for_response(seq)['value']
                 cache.status = SLOT_OK
 
             value = cache.value
         else:
+            seq = self._next_seq()
             self.send_message({
                 'get': {
-                    'seq': self._next_seq(),
+                    'seq': seq,
                     'var': var,
                     'key': key,
                     }
                 })
-            value = self._wait_for_response()['value']
+            value = self._wait_for_response(seq)['value']
 
         if value is None:
             raise KeyError(key)
 
         return value
 
+    def _write(self, var, key, value, message):
+        if not self.write_coalesce:
+            self.send_message(message)
+            return
+
+        # Only the most recent write to a key needs to be sent
+        self.write_buffer[(var, key)] = (value, message)
+
+        if len(self.write_buffer) >= MAX_WRITE_BUFFER:
+            self.flush_writes()
+
+    def _queue_writes(self):
+        for value, message in self.write_buffer.values():
+            self.send_message(message, batch=True)
+        self.write_buffer = {}
+
+    def flush_writes(self):
+        self._queue_writes()
+        self.flush()
+
     def delete(self, var, key):
         m = {
             'seq': self._next_seq(),
@@ -232,14 +363,27 @@ class Client(IPC):
             cache.status = SLOT_OK
             m['slot'] = cache.slot
 
-        self.send_message({'del': m})
+        self._write(var, key, None, {'del': m})
 
     def contains(self, var, key):
-        try:
-            value = self.get(var, key)
-            return True
-        except KeyError:
-            return False
+        k = (var, key)
+        if k in self.write_buffer:
+            return self.write_buffer[k][0] is not None
+
+        if self.use_cache:
+            cache = self.cache.get(k)
+            if cache is not None and cache.status == SLOT_OK:
+                return cache.value is not None
+
+        seq = self._next_seq()
+        self.send_message({
+            'contains': {
+                'seq': seq,
+                'var': var,
+                'key': key,
+                }
+            })
+        return self._wait_for_response(seq)['value']
 
     def getdefault(self, var, key, default=None):
         try:
@@ -247,7 +391,7 @@ class Client(IPC):
         except KeyError:
             return default
 
-    def set(self, var, key, value):
+    def _set_message(self, var, key, value):
         m = {
             'seq': self._next_seq(),
             'var': var,
@@ -261,20 +405,55 @@ class Client(IPC):
             cache.status = SLOT_OK
             m['slot'] = cache.slot
 
-        self.send_message({'set': m})
+        return {'set': m}
 
-    def setdefault(self, var, key, default=None):
-        try:
-            return self.get(var, key)
-        except KeyError:
-            self.set(var, key, default)
-            return default
+    def set(self, var, key, value):
+        self._write(var, key, value, self._set_message(var, key, value))
 
-    def sync(self):
+    def bulk_set(self, var, items):
+        if self.write_coalesce:
+            for key, value in items:
+                self.set(var, key, value)
+        else:
+            self.send_message_batch([self._set_message(var, key, value) for key, value in items])
+
+    def setdefault(self, var, key, default=None):
+        k = (var, key)
+        if k in self.write_buffer:
+            value = self.write_buffer[k][0]
+            if value is None:
+                self.set(var, key, default)
+                return default
+            return value
+
+        seq = self._next_seq()
         m = {
-            'seq': self._next_seq()
+            'seq': seq,
+            'var': var,
+            'key': key,
+            'default': default,
             }
 
-        self.send_message({'sync': m})
-        self._wait_for_response()
+        if self.use_cache:
+            cache = self._get_cache(var, key)
+            if cache.status == SLOT_OK and cache.value is not None:
+                return cache.value
+            m['slot'] = cache.slot
+
+        self.send_message({'setdefault': m})
+        value = self._wait_for_response(seq)['value']
+
+        if self.use_cache:
+            cache.value = value
+            cache.status = SLOT_OK
+
+        return value
+
+    def sync(self):
+        self._queue_writes()
+
+        seq = self._next_seq()
+
+        self.send_message({'sync': {'seq': seq}})
+        self._wait_for_response(seq)
 
@@ -20,6 +20,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from contextlib import contextmanager
+import collections
 import sqlite3
 import logging
 import json
@@ -50,42 +52,101 @@ class DBManager(object):
             raise
 
 class Sqlite3DB(object):
-    def __init__(self, db_path, *args, **kwargs):
+    """
+    Database stored in a sqlite3 file. If cache_size is set, up to that many
+    decoded values are kept in memory, which is only safe if nothing else
+    writes to the file
+    """
+    def __init__(self, db_path, *args, cache_size=0, **kwargs):
         self.db_path = db_path
+        self.cache_size = cache_size
+        self.value_cache = collections.OrderedDict()
 
         self.db = sqlite3.connect(db_path, *args, **kwargs)
         self.db.text_factory = str
 
         self.cursor = self.db.cursor()
+        self.batch_depth = 0
 
         self.cursor.execute("pragma journal_mode = WAL;")
+        # Safe with WAL, and avoids a sync on every commit
+        self.cursor.execute("pragma synchronous = NORMAL;")
         self.cursor.execute("CREATE TABLE IF NOT EXISTS data(key TEXT PRIMARY KEY NOT NULL, value TEXT);")
         self.db.commit()
 
+    def _cache_value(self, key, value):
+        # Only string keys are cached, since sqlite converts other key types
+        # to text and they could alias each other
+        if isinstance(key, str):
+            if self.cache_size:
+                self.value_cache[key] = value
+                self.value_cache.move_to_end(key)
+                if len(self.value_cache) > self.cache_size:
+                    self.value_cache.popitem(last=False)
+        else:
+            # The row may also be cached under a string key
+            self.value_cache.clear()
+
     def __getitem__(self, key):
-        logger.debug('Getting %s', key)
+        try:
+            value = self.value_cache[key]
+            self.value_cache.move_to_end(key)
+            return value
+        except KeyError:
+            pass
 
         self.cursor.execute("SELECT * from data where key=?;", [key])
         row = self.cursor.fetchone()
-        logger.debug('%s = %s', key, row)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Getting %s = %s', key, row)
         if row is not None:
-            return json.loads(row[1])
+            value = json.loads(row[1])
+            self._cache_value(key, value)
+            return value
         raise KeyError
 
     def __setitem__(self, key, value):
-        logger.debug('Setting %s = %s', key, value)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Setting %s = %s', key, value)
 
-        self.cursor.execute("SELECT * from data where key=?;", [key])
-        row = self.cursor.fetchone()
-        if row is not None:
-            self.cursor.execute("UPDATE data SET value=? WHERE key=?;", [json.dumps(value), key])
-        else:
-            self.cursor.execute("INSERT into data(key, value) values (?, ?);", [key, json.dumps(value)])
-        self.db.commit()
+        encoded = json.dumps(value)
+        self.cursor.execute("INSERT OR REPLACE INTO data(key, value) VALUES (?, ?);", [key, encoded])
+        self._commit()
+        if self.cache_size:
+            # Cache what a read from the database would return, not the
+            # caller's object
+            self._cache_value(key, json.loads(encoded))
 
     def __delitem__(self, key):
-        logger.debug('Deleting %s', key)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Deleting %s', key)
         self.cursor.execute("DELETE from data where key=?;", [key])
-        self.db.commit()
+        self._commit()
+        if isinstance(key, str):
+            self.value_cache.pop(key, None)
+        else:
+            self.value_cache.clear()
+
+    def _commit(self):
+        if not self.batch_depth:
+            self.db.commit()
+
+    @contextmanager
+    def batch(self):
+        """
+        Defers committing changes until the end of the outermost block. If a
+        block raises an exception, all uncommitted changes are rolled back
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.db.rollback()
+            # Cached values may not match the database anymore
+            self.value_cache.clear()
+            raise
+        finally:
+            self.batch_depth -= 1
+        self._commit()
 
 
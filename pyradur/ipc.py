@@ -21,16 +21,25 @@
 # SOFTWARE.
 
 import array
-import copy
 import json
 import logging
 import os
 import socket
+import struct
 
 logger = logging.getLogger('pyradur.ipc')
 
 MAX_FDS = 1
-MAX_MESSAGE = 4096
+MAX_MESSAGE = 65536
+MAX_BATCH = 65536
+# sendmsg() accepts at most IOV_MAX buffers on Linux
+MAX_BATCH_BUFFERS = 1024
+
+# Allows a full batch of messages to be queued without blocking the sender
+SOCKET_SEND_BUFFER = 1 << 20
+
+# Each message is prefixed with its length
+HEADER = struct.Struct('>I')
 
 STATUS_OK = 'ok'
 STATUS_NO_VAR = 'no_var'
@@ -39,8 +48,17 @@ STATUS_NO_KEY = 'no_key'
 class IPC(object):
     def __init__(self, sock, logger=logger):
         self.sock = sock
-        self.recv_buffer = bytearray()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SEND_BUFFER)
+        # Messages are received into a preallocated buffer. Complete
+        # messages are in recv_buffer[read_pos:recv_end]
+        self.recv_buffer = bytearray(MAX_MESSAGE)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.read_pos = 0
+        self.recv_end = 0
         self.recv_fds = []
+        self.send_pending = []
+        self.send_pending_fds = []
+        self.send_pending_size = 0
         self.logger = logger
         self.eof = False
         self.is_open = True
@@ -56,69 +74,165 @@ class IPC(object):
 
     def close(self):
         if self.is_open:
-            self._do_close()
+            # Cleared first so a failed close isn't retried on already closed
+            # file descriptors
             self.is_open = False
+            self._do_close()
 
-    def send_message(self, r, fds=[]):
+    def send_message(self, r, fds=[], batch=False):
         if fds:
-            r = copy.copy(r)
+            # Messages are always constructed for the call, so it is safe to
+            # modify them
             r['fds'] = len(fds)
-        msg = json.dumps(r)
-        self.logger.debug('sending message %s, %s', msg, fds)
-        ret = self.sock.sendmsg([(msg + '\0').encode('utf-8')], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
 
-    def _recv(self, buflen):
+            # The receiver only accepts MAX_FDS file descriptors per read, so
+            # don't let them accumulate in a batch
+            if self.send_pending_fds:
+                self.flush()
+
+        msg = json.dumps(r, separators=(',', ':'))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('sending message %s, %s', msg, fds)
+        data = msg.encode('utf-8')
+
+        self.send_pending.append(HEADER.pack(len(data)))
+        self.send_pending.append(data)
+        self.send_pending_fds.extend(fds)
+        self.send_pending_size += HEADER.size + len(data)
+
+        if not batch or self.send_pending_size >= MAX_BATCH or len(self.send_pending) >= MAX_BATCH_BUFFERS:
+            self.flush()
+
+    def send_message_batch(self, messages):
+        for r in messages:
+            self.send_message(r, batch=True)
+        self.flush()
+
+    def flush(self):
+        if not self.send_pending:
+            return
+
+        # All pending messages are sent with a single sendmsg() call, unless
+        # it only accepts part of the data
+        buffers = self.send_pending
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", self.send_pending_fds))]
+        while buffers:
+            sent = self.sock.sendmsg(buffers, ancdata)
+
+            # The file descriptors are sent with the first chunk only
+            ancdata = []
+
+            i = 0
+            while i < len(buffers) and sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            buffers = buffers[i:]
+
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+        self.send_pending = []
+        self.send_pending_fds = []
+        self.send_pending_size = 0
+
+    def _resize_recv_buffer(self, size):
+        # The buffer can't be resized while the view exists
+        self.recv_view.release()
+        self.recv_buffer.extend(bytes(size - len(self.recv_buffer)))
+        self.recv_view = memoryview(self.recv_buffer)
+
+    def _recv(self, flags=0):
         recv_fds = array.array("i")
 
-        self.logger.debug('waiting for message')
-        buf, ancdata, flags, addr = self.sock.recvmsg(buflen, socket.CMSG_SPACE(MAX_FDS * recv_fds.itemsize))
+        if self.recv_end == len(self.recv_buffer):
+            self._resize_recv_buffer(len(self.recv_buffer) * 2)
+
+        nbytes, ancdata, msg_flags, addr = self.sock.recvmsg_into([self.recv_view[self.recv_end:]],
+                socket.CMSG_SPACE(MAX_FDS * recv_fds.itemsize), flags)
 
         for cmsg_level, cmsg_type, cmsg_data in ancdata:
             if (cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS):
                 # Append data, ignoring any truncated integers at the end.
                 recv_fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % recv_fds.itemsize)])
-                self.recv_fds.extend(list(recv_fds))
-                self.logger.debug("Received fds: %s, %s", list(recv_fds), self.recv_fds)
-
-        return buf
-
-    def process_receive(self, handlers):
-        buf = self._recv(MAX_MESSAGE)
-
-        if not buf:
-            self.logger.debug('EOF')
-            self.eof = True
+                self.recv_fds.extend(recv_fds)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Received fds: %s, %s", list(recv_fds), self.recv_fds)
 
-        self.logger.debug('got message: %s', buf.decode('utf-8'))
-        self.recv_buffer.extend(buf)
+        self.recv_end += nbytes
+        return nbytes
 
-        idx = self.recv_buffer.find(b'\x00')
+    def _process_messages(self, handlers, debug):
+        while self.recv_end - self.read_pos >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.recv_buffer, self.read_pos)
+            start = self.read_pos + HEADER.size
+            end = start + length
+            if end > self.recv_end:
+                break
 
-        while idx != -1:
-            s = self.recv_buffer[:idx].decode('utf-8')
-            self.recv_buffer = self.recv_buffer[idx + 1:]
+            s = str(self.recv_view[start:end], 'utf-8')
+            self.read_pos = end
 
             message = json.loads(s)
 
             num_fds = message.get('fds', 0)
 
             if len(self.recv_fds) < num_fds:
-                raise Exception("Not enough file descriptors. Want %d, have %d" % (num_fds, len(num_fds)))
+                raise Exception("Not enough file descriptors. Want %d, have %d" % (num_fds, len(self.recv_fds)))
 
             # If the handler needs to keep around a file descriptor, it must
             # dup them since they will be closed later
             message_fds = self.recv_fds[:num_fds]
             self.recv_fds = self.recv_fds[num_fds:]
 
-            self.logger.debug('Got message: %s, %s', s, message_fds)
+            if debug:
+                self.logger.debug('Got message: %s, %s', s, message_fds)
 
-            for k, v in handlers.items():
-                if k in message:
-                    v(message[k], message_fds)
+            # A message only carries its operation (and maybe 'fds'), so look
+            # up its keys rather than scanning every handler
+            for k, v in message.items():
+                h = handlers.get(k)
+                if h is not None:
+                    h(v, message_fds)
 
             # Close all received fds
             for fd in message_fds:
                 os.close(fd)
 
-            idx = self.recv_buffer.find(b'\x00')
+        # Move any partial message to the start of the buffer, and make sure
+        # there is room for all of it
+        remaining = self.recv_end - self.read_pos
+        if remaining and self.read_pos:
+            self.recv_view[:remaining] = self.recv_view[self.read_pos:self.recv_end]
+        self.read_pos = 0
+        self.recv_end = remaining
+
+        if remaining >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.recv_buffer)
+            if HEADER.size + length > len(self.recv_buffer):
+                self._resize_recv_buffer(HEADER.size + length)
+
+    def process_receive(self, handlers):
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+
+        nbytes = self._recv()
+
+        while True:
+            if not nbytes:
+                self.logger.debug('EOF')
+                self.eof = True
+            elif debug:
+                self.logger.debug('got %d bytes', nbytes)
+
+            full = self.recv_end == len(self.recv_buffer)
+
+            self._process_messages(handlers, debug)
+
+            # A full read means more data is probably waiting, so drain it
+            # without blocking
+            if not full:
+                break
 
+            try:
+                nbytes = self._recv(socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
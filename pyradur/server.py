@@ -21,18 +21,24 @@
 # SOFTWARE.
 
 from .ipc import IPC, STATUS_OK, STATUS_NO_VAR, STATUS_NO_KEY
-from .shm import SHMSlot, SLOT_UNUSED, SLOT_OK, SLOT_OUT_OF_DATE
+from .shm import SLOT_UNUSED, SLOT_OK, SLOT_OUT_OF_DATE
 from .db import DBManager
 from contextlib import contextmanager
+import ctypes
 import logging
 import mmap
 import os
-import select
+import selectors
 import socket
 import threading
 
 logger = logging.getLogger('pyradur.server')
 
+_STATUS_OK = (STATUS_OK,)
+
+# Hoisted out of the event loop
+EVENT_READ = selectors.EVENT_READ
+
 class SockServer(object):
     class Client(IPC):
         def __init__(self, sock, addr, db, report_change):
@@ -40,85 +46,159 @@ class SockServer(object):
             self.addr = addr
             self.buffer = []
             self.db = db
-            self.shm_fd = -1
             self.shm = None
+            self.shm_view = None
+            # Cached slot numbers, keyed by variable and then by key. The
+            # status bytes are written directly through shm_view
             self.cache = {}
+            # One past the highest slot the client has told the server about
+            self._max_slot = 0
             self.report_change = report_change
+            self._dispatch = {
+                'get': self._process_get,
+                'set': self._process_set,
+                'del': self._process_del,
+                'contains': self._process_contains,
+                'setdefault': self._process_setdefault,
+                'shm': self._process_shm,
+                'release': self._process_release,
+                'release-all': self._process_release_all,
+                'sync': self._process_sync,
+                'validate-vars': self._process_validate_vars,
+                }
 
         def _do_close(self):
             self.close_shm()
             super()._do_close()
 
         def close_shm(self):
+            # The mapping can't be closed while the view exists
+            if self.shm_view is not None:
+                self.shm_view.release()
+            self.shm_view = None
+
             if self.shm is not None:
                 self.shm.close()
             self.shm = None
 
-            if self.shm_fd != -1:
-                os.close(self.shm_fd)
-            self.shm_fd = -1
-
         def mark_change(self, var, key):
-            k = (var, key)
-            if k in self.cache:
-                self.cache[k].status = SLOT_OUT_OF_DATE
-
-        def _send_response(self, response):
-            self.send_message({'response': response})
+            slots = self.cache.get(var)
+            if slots is not None:
+                slot = slots.get(key)
+                if slot is not None:
+                    self.shm_view[slot] = SLOT_OUT_OF_DATE
 
         def _add_slot(self, req):
             slot = req.get('slot', None)
             if slot is not None and self.shm is not None:
-                logger.debug('Added slot %d', slot)
-                k = (req['var'], req['key'])
-                self.cache[k] = SHMSlot(slot, self.shm, logger=logger)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Added slot %d', slot)
+                var = req['var']
+                slots = self.cache.get(var)
+                if slots is None:
+                    slots = self.cache[var] = {}
+                slots[req['key']] = slot
+                if slot >= self._max_slot:
+                    self._max_slot = slot + 1
 
         def _db_op(self, var, key, op):
             try:
                 db = self.db.get_db(var)
                 try:
                     op(db)
-                    return [STATUS_OK]
+                    return _STATUS_OK
                 except KeyError:
-                    logger.debug('No key %s.%s', var, key)
-                    return [STATUS_NO_KEY, key]
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug('No key %s.%s', var, key)
+                    return (STATUS_NO_KEY, key)
             except KeyError:
-                return [STATUS_NO_VAR, var]
+                return (STATUS_NO_VAR, var)
 
         def _process_get(self, m, fds):
-            def op(db):
-                response['value'] = db[key]
-
             var = m['var']
             key = m['key']
 
-            response = {'seq': m['seq']}
-            response['status'] = self._db_op(var, key, op)
+            try:
+                db = self.db.get_db(var)
+                try:
+                    value = db[key]
+                    status = _STATUS_OK
+                except KeyError:
+                    status = (STATUS_NO_KEY, key)
+            except KeyError:
+                status = (STATUS_NO_VAR, var)
 
-            self._send_response(response)
+            if status is _STATUS_OK:
+                self.send_message({'response': {'seq': m['seq'], 'status': status, 'value': value}})
+            else:
+                self.send_message({'response': {'seq': m['seq'], 'status': status}})
             self._add_slot(m)
 
         def _process_set(self, m, fds):
-            def op(db):
-                db[key] = m['value']
-
             var = m['var']
             key = m['key']
 
-            self._db_op(var, key, op)
+            try:
+                self.db.get_db(var)[key] = m['value']
+            except KeyError:
+                pass
+
             self._add_slot(m)
             self.report_change(self, var, key)
 
         def _process_del(self, m, fds):
+            var = m['var']
+            key = m['key']
+
+            try:
+                del self.db.get_db(var)[key]
+            except KeyError:
+                pass
+
+            self._add_slot(m)
+            self.report_change(self, var, key)
+
+        def _process_contains(self, m, fds):
+            def op(db):
+                try:
+                    response['value'] = db[key] is not None
+                except KeyError:
+                    response['value'] = False
+
+            var = m['var']
+            key = m['key']
+
+            response = {'seq': m['seq']}
+            response['status'] = self._db_op(var, key, op)
+
+            self.send_message({'response': response})
+
+        def _process_setdefault(self, m, fds):
             def op(db):
-                del db[key]
+                nonlocal changed
+                try:
+                    value = db[key]
+                except KeyError:
+                    value = None
+
+                if value is None:
+                    value = m['default']
+                    db[key] = value
+                    changed = True
+
+                response['value'] = value
 
             var = m['var']
             key = m['key']
+            changed = False
 
-            self._db_op(var, key, op)
+            response = {'seq': m['seq']}
+            response['status'] = self._db_op(var, key, op)
+
+            self.send_message({'response': response})
             self._add_slot(m)
-            self.report_change(self, var, key)
+            if changed:
+                self.report_change(self, var, key)
 
         def _process_shm(self, m, fds):
             self.close_shm()
@@ -126,79 +206,61 @@ class SockServer(object):
             self.shm_size = m['size']
 
             if self.shm_size > 0:
-                self.shm_fd = os.dup(fds[0])
+                # The mapping keeps its own reference to the file, so the
+                # received fd is left for the IPC layer to close
+                self.shm = mmap.mmap(fds[0], self.shm_size)
+                self.shm_view = memoryview(self.shm)
 
-                self.shm = mmap.mmap(self.shm_fd, self.shm_size)
+            # Growing the shared memory doesn't wait for a response
+            if 'seq' in m:
+                self.send_message({'response': {'seq': m['seq'], 'status': _STATUS_OK}})
 
-            self._send_response({
-                'seq': m['seq'],
-                'status': [STATUS_OK]
-                })
-            logger.debug("shm fd is now %d", self.shm_fd)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("shm size is now %d", self.shm_size)
 
         def _process_release(self, m, fds):
             var = m['var']
             key = m['key']
 
-            k = (var, key)
+            slots = self.cache.get(var)
+            if slots is None:
+                return
 
-            if k in self.cache:
-                logger.debug('Released slot %d', self.cache[k].slot)
-                self.cache[k].status = SLOT_UNUSED
-                del self.cache[k]
+            slot = slots.pop(key, None)
+            if slot is not None:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Released slot %d', slot)
+                self.shm_view[slot] = SLOT_UNUSED
 
         def _process_release_all(self, m, fds):
-            if self.shm is not None:
-                self.shm[:] = bytearray(self.shm_size)
+            if self.shm is not None and self._max_slot:
+                # Clear the mapping in place. Only slots the server has been
+                # told about can be in use, so the rest is left untouched. The
+                # ctypes object holds an export of the mapping, so it must not
+                # be kept around
+                view = ctypes.c_char.from_buffer(self.shm)
+                ctypes.memset(ctypes.addressof(view), SLOT_UNUSED, self._max_slot)
+                del view
             self.cache = {}
+            self._max_slot = 0
 
         def _process_sync(self, m, fds):
-            self._send_response({
-                'seq': m['seq'],
-                'status': [STATUS_OK]
-                })
+            self.send_message({'response': {'seq': m['seq'], 'status': _STATUS_OK}})
 
-        def _process_validate_var(self, m, fds):
-            response = {'seq': m['seq']}
-            response['status'] = self._db_op(m['var'], None, lambda db: None)
-
-            self._send_response(response)
-
-        def handle_poll(self, event):
-            if event.read:
-                self.process_receive({
-                    'get': self._process_get,
-                    'set': self._process_set,
-                    'del': self._process_del,
-                    'shm': self._process_shm,
-                    'release': self._process_release,
-                    'release-all': self._process_release_all,
-                    'sync': self._process_sync,
-                    'validate-var': self._process_validate_var,
-                    })
-
-    class Event(object):
-        def __init__(self, fd, read, hup):
-            self.fd = fd
-            self.read = bool(read)
-            self.hup = bool(hup)
-
-    class EPoll(object):
-        def __init__(self):
-            self.epoll = select.epoll()
-
-        def register(self, fd):
-            self.epoll.register(fd, select.EPOLLIN)
-
-        def unregister(self, fd):
-            self.epoll.unregister(fd)
-
-        def poll(self, timeout):
-            return [SockServer.Event(fd, events & select.EPOLLIN, events & select.EPOLLHUP)
-                    for fd, events in self.epoll.poll(timeout)]
-
-        def fileno(self):
-            return self.epoll.fileno()
+        def _process_validate_vars(self, m, fds):
+            response = {'seq': m['seq'], 'status': _STATUS_OK}
+
+            for var in m['vars']:
+                status = self._db_op(var, None, lambda db: None)
+                if status is not _STATUS_OK:
+                    response['status'] = status
+                    break
+
+            self.send_message({'response': response})
+
+        def handle_poll(self, events):
+            if events & EVENT_READ:
+                self.process_receive(self._dispatch)
 
     def __init__(self, sock_path, db=None):
         self.sock_path = sock_path
@@ -213,21 +275,25 @@ class SockServer(object):
         except OSError:
             pass
 
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Python already makes sockets non-inheritable, but SOCK_CLOEXEC sets
+        # it atomically when the socket is created where it is supported
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | getattr(socket, 'SOCK_CLOEXEC', 0))
         self.sock.setblocking(False)
         self.sock.bind(self.sock_path)
-        self.sock.listen(10)
+        self.sock.listen(socket.SOMAXCONN)
+        self._listen_fd = self.sock.fileno()
 
-        for p in (self.EPoll,):
-            try:
-                self.poll = p()
-                break
-            except AttributeError:
-                pass
-        else:
-            raise Exception("No suitable poll interface found")
+        # Picks epoll, kqueue, etc. depending on the platform
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self._listen_fd, EVENT_READ)
 
-        self.poll.register(self.sock.fileno())
+        # Written to by shutdown() so that serve_forever() doesn't need a
+        # timeout to notice it has been asked to stop
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._wakeup_fd = self._wakeup_r.fileno()
+        self.selector.register(self._wakeup_fd, EVENT_READ)
 
         self.done = threading.Event()
         self.done.set()
@@ -238,46 +304,70 @@ class SockServer(object):
     def close(self):
         logger.debug('Closing server')
         self.sock.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
 
         for client in self.clients.values():
             client.close()
 
     def _report_change(self, source, var, key):
         for c in self.clients.values():
-            if c is not source:
-                c.mark_change(var, key)
+            if c is source:
+                continue
+            slots = c.cache.get(var)
+            if slots is None:
+                continue
+            slot = slots.get(key)
+            if slot is not None:
+                c.shm_view[slot] = SLOT_OUT_OF_DATE
 
     def _handle_poll_events(self, events):
-        for e in events:
-            if e.fd == self.sock.fileno():
-                try:
-                    conn, addr = self.sock.accept()
-                    logger.debug('New client %d, %s', conn.fileno(), addr)
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        for key, mask in events:
+            fd = key.fd
+            if fd == self._listen_fd:
+                # Accept every pending connection instead of one per wakeup
+                while True:
+                    try:
+                        conn, addr = self.sock.accept()
+                    except (BlockingIOError, socket.timeout):
+                        break
+
+                    if debug:
+                        logger.debug('New client %d, %s', conn.fileno(), addr)
 
                     self.clients[conn.fileno()] = self.Client(conn, addr, self.db, self._report_change)
 
-                    self.poll.register(conn.fileno())
-                except socket.timeout:
+                    self.selector.register(conn.fileno(), EVENT_READ)
+
+            elif fd == self._wakeup_fd:
+                try:
+                    while self._wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
                     pass
 
-            elif e.fd in self.clients:
-                client = self.clients[e.fd]
+            elif fd in self.clients:
+                client = self.clients[fd]
                 try:
-                    client.handle_poll(e)
+                    client.handle_poll(mask)
                 except (BrokenPipeError, ConnectionResetError):
-                    pass
+                    client.eof = True
 
-                if e.hup or client.eof:
-                    logging.debug('Client %d disconnected', e.fd)
-                    self.poll.unregister(e.fd)
+                # A hangup is seen as a read that returns no data
+                if client.eof:
+                    if debug:
+                        logger.debug('Client %d disconnected', fd)
+                    self.selector.unregister(fd)
                     client.close()
-                    del self.clients[e.fd]
+                    del self.clients[fd]
 
     def get_fd(self):
-        return self.poll.fileno()
+        return self.selector.fileno()
 
     def handle_event(self):
-        events = self.poll.poll(0)
+        events = self.selector.select(0)
         self._handle_poll_events(events)
 
     def suspend(self):
@@ -302,7 +392,7 @@ class SockServer(object):
         pass
 
     def handle_request(self):
-        events = self.poll.poll(0)
+        events = self.selector.select(0)
         self._handle_poll_events(events)
         return bool(events)
 
@@ -312,7 +402,10 @@ class SockServer(object):
 
         try:
             while self.keep_serving:
-                events = self.poll.poll(poll_interval)
+                # With no clients connected there is nothing to do until a
+                # client connects or shutdown() wakes the loop, so don't wake
+                # up periodically
+                events = self.selector.select(poll_interval if self.clients else None)
 
                 retry = False
                 with self._suspended_cond:
@@ -331,6 +424,12 @@ class SockServer(object):
     def shutdown(self):
         logger.debug('shutdown')
         self.keep_serving = False
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            # Either a wakeup is already pending, or the server has been
+            # closed and there is nothing to wake up
+            pass
         self.done.wait()
 
 
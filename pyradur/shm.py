@@ -20,7 +20,6 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os
 import logging
 
 logger = logging.getLogger('pyradur.shm')
@@ -42,13 +41,12 @@ class SHMSlot(object):
 
     @property
     def status(self):
-        self.shm.seek(self.slot, os.SEEK_SET)
-        return self.shm.read_byte()
+        return self.shm[self.slot]
 
     @status.setter
     def status(self, status):
-        self.logger.debug("Setting slot %d to %r", self.slot, status)
-        self.shm.seek(self.slot, os.SEEK_SET)
-        self.shm.write_byte(status)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Setting slot %d to %r", self.slot, status)
+        self.shm[self.slot] = status
 
 
@@ -34,6 +34,7 @@ import sys
 class CommonTests(object):
     use_cache = True
     close_on_cleanup = True
+    write_coalesce = False
 
     def _server_thread(self, event):
         try:
@@ -88,7 +89,8 @@ class CommonTests(object):
         self.assertDictEqual(self.server.clients, {})
 
     def get_dict(self, name, share_connection=True):
-        d = Dict(self.sock_path, name, use_cache=self.use_cache, share_connection=share_connection)
+        d = Dict(self.sock_path, name, use_cache=self.use_cache, share_connection=share_connection,
+                write_coalesce=self.write_coalesce)
         if self.close_on_cleanup:
             self.addCleanup(lambda: d.close())
         return d
@@ -101,15 +103,28 @@ class CommonTests(object):
         with self.assertRaises(KeyError):
             d['baz']
 
+    def test_large_value(self):
+        a = self.get_dict('var', share_connection=False)
+        b = self.get_dict('var', share_connection=False)
+
+        value = 'x' * (1024 * 1024)
+        a['foo'] = value
+        a['bar'] = 'baz'
+        a.sync()
+        self.assertEqual(b['foo'], value)
+        self.assertEqual(b['bar'], 'baz')
+
     def test_get_set_shared(self):
         a = self.get_dict('var')
         b = self.get_dict('var')
+        self.assertIs(a.client, b.client)
         a['foo'] = 'bar'
         self.assertEqual(b['foo'], 'bar')
 
     def test_get_set_nonshared(self):
         a = self.get_dict('var', share_connection=False)
         b = self.get_dict('var', share_connection=False)
+        self.assertIsNot(a.client, b.client)
         a['foo'] = 'bar'
         a.sync()
         self.assertEqual(b['foo'], 'bar')
@@ -135,6 +150,21 @@ class CommonTests(object):
         with self.assertRaises(KeyError):
             b['foo']
 
+    def test_bulk_set(self):
+        a = self.get_dict('var', share_connection=False)
+        b = self.get_dict('var', share_connection=False)
+
+        a.bulk_set({'foo': 'bar', 'baz': 'bat'})
+        a.sync()
+        self.assertEqual(a['foo'], 'bar')
+        self.assertEqual(b['foo'], 'bar')
+        self.assertEqual(b['baz'], 'bat')
+
+        a.bulk_set([('foo', 'test%d' % i) for i in range(1000)])
+        a.sync()
+        self.assertEqual(a['foo'], 'test999')
+        self.assertEqual(b['foo'], 'test999')
+
     def test_setdefault(self):
         a = self.get_dict('var', share_connection=False)
         b = self.get_dict('var', share_connection=False)
@@ -143,6 +173,10 @@ class CommonTests(object):
         a.sync()
         self.assertEqual(b['foo'], 'bar')
 
+        self.assertEqual(b.setdefault('foo', 'baz'), 'bar')
+        self.assertEqual(a.setdefault('foo', 'baz'), 'bar')
+        self.assertEqual(b['foo'], 'bar')
+
     def test_server_suspend(self):
         a = self.get_dict('var', share_connection=False)
         a['foo'] = 'bar'
@@ -162,6 +196,13 @@ class CommonTests(object):
         self.assertTrue('foo' in b)
         self.assertFalse('bar' in b)
 
+        self.assertEqual(b['foo'], 'bar')
+        self.assertTrue('foo' in b)
+
+        del a['foo']
+        a.sync()
+        self.assertFalse('foo' in b)
+
 
     def test_cache_grow(self):
         import mmap
@@ -304,6 +345,90 @@ class CacheTests(CommonTests, unittest.TestCase):
         a.sync()
         self.assertEqual(b['foo'], 'test')
 
+    def test_cache_grow_change(self):
+        import mmap
+
+        a = self.get_dict('var', share_connection=False)
+        b = self.get_dict('var', share_connection=False)
+
+        b['foo'] = 'bar'
+        b.sync()
+        self.assertEqual(a['foo'], 'bar')
+
+        for i in range(mmap.PAGESIZE * 2):
+            a['foo%d' % i] = 'bar%d' % i
+        a.sync()
+
+        b['foo'] = 'baz'
+        b.sync()
+        self.assertEqual(a['foo'], 'baz')
+
+    def test_missing_key_slot(self):
+        a = self.get_dict('var', share_connection=False)
+        b = self.get_dict('var', share_connection=False)
+
+        with self.assertRaises(KeyError):
+            a['foo']
+
+        b['bar'] = 'baz'
+        b.sync()
+        self.assertEqual(a['bar'], 'baz')
+
+        b['foo'] = 'test'
+        b.sync()
+        self.assertEqual(a['bar'], 'baz')
+        self.assertEqual(a['foo'], 'test')
+
+class NoCacheWriteCoalesceTests(NoCacheTests):
+    write_coalesce = True
+
+class WriteCoalesceTests(CacheTests):
+    write_coalesce = True
+
+    def test_share_coalesce(self):
+        a = self.get_dict('var')
+        b = Dict(self.sock_path, 'var', write_coalesce=False)
+        self.addCleanup(b.close)
+        self.assertIsNot(a.client, b.client)
+        self.assertIs(a.client, self.get_dict('var').client)
+
+        b['foo'] = 'bar'
+        b.sync()
+        self.assertEqual(a['foo'], 'bar')
+
+    def test_coalesce(self):
+        a = self.get_dict('var', share_connection=False)
+        b = self.get_dict('var', share_connection=False)
+
+        a['foo'] = 'bar'
+        a['foo'] = 'baz'
+        self.assertEqual(a['foo'], 'baz')
+        del a['foo']
+        with self.assertRaises(KeyError):
+            a['foo']
+        a['foo'] = 'test'
+
+        a.sync()
+        self.assertEqual(b['foo'], 'test')
+
+    def test_close_after_shutdown(self):
+        d = self.get_dict('var', share_connection=False)
+        client = d.client
+
+        d['foo'] = 'bar'
+
+        self.server.shutdown()
+        self.server_thread.join()
+        # The server stopped before it could see the client disconnect
+        self.server.clients.clear()
+
+        with self.assertRaises((BrokenPipeError, ConnectionResetError)):
+            client.close()
+
+        self.assertFalse(client.is_open)
+        self.assertEqual(client.sock.fileno(), -1)
+        self.assertTrue(client.shm.closed)
+
 class ImplicitCloseTests(CacheTests):
     close_on_cleanup = False
 
@@ -330,3 +455,85 @@ class ImplicitCloseTests(CacheTests):
 
         b['test'] = 'blah'
 
+
+class Sqlite3DBTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='pyradur-')
+        self.addCleanup(shutil.rmtree, self.tempdir, ignore_errors=True)
+        self.db_path = os.path.join(self.tempdir, 'db.sqlite3')
+
+    def test_get_set(self):
+        db = Sqlite3DB(self.db_path)
+        db['foo'] = 'bar'
+        self.assertEqual(db['foo'], 'bar')
+        db['foo'] = {'baz': [1, 2]}
+        self.assertEqual(db['foo'], {'baz': [1, 2]})
+
+        del db['foo']
+        with self.assertRaises(KeyError):
+            db['foo']
+
+    def test_value_cache(self):
+        db = Sqlite3DB(self.db_path, cache_size=2)
+        for i in range(4):
+            db['foo%d' % i] = i
+        self.assertEqual(list(db.value_cache), ['foo2', 'foo3'])
+
+        self.assertEqual(db['foo0'], 0)
+        self.assertEqual(db['foo2'], 2)
+        self.assertEqual(list(db.value_cache), ['foo0', 'foo2'])
+
+        del db['foo0']
+        self.assertNotIn('foo0', db.value_cache)
+        with self.assertRaises(KeyError):
+            db['foo0']
+
+    def test_value_cache_alias(self):
+        db = Sqlite3DB(self.db_path, cache_size=2)
+        db['1'] = 'a'
+        db[1] = 'b'
+        self.assertEqual(db['1'], 'b')
+
+        del db[1]
+        with self.assertRaises(KeyError):
+            db['1']
+
+    def test_value_cache_copy(self):
+        db = Sqlite3DB(self.db_path, cache_size=2)
+        v = [1, 2]
+        db['foo'] = v
+        v.append(3)
+        self.assertEqual(db['foo'], [1, 2])
+
+        db['foo'] = (1, 2)
+        self.assertEqual(db['foo'], [1, 2])
+
+    def test_batch(self):
+        db = Sqlite3DB(self.db_path)
+        other = Sqlite3DB(self.db_path)
+        with db.batch():
+            for i in range(100):
+                db['foo%d' % i] = i
+            with db.batch():
+                db['foo0'] = 'bar'
+
+            with self.assertRaises(KeyError):
+                other['foo0']
+
+        self.assertEqual(other['foo0'], 'bar')
+        self.assertEqual(other['foo99'], 99)
+
+    def test_batch_rollback(self):
+        db = Sqlite3DB(self.db_path, cache_size=2)
+        db['foo'] = 'bar'
+
+        with self.assertRaises(ValueError):
+            with db.batch():
+                db['foo'] = 'baz'
+                db['test'] = 'blah'
+                raise ValueError()
+
+        self.assertEqual(db['foo'], 'bar')
+        with self.assertRaises(KeyError):
+            db['test']
+        self.assertEqual(Sqlite3DB(self.db_path)['foo'], 'bar')